@@ -0,0 +1,258 @@
+"""
+Ricatalogazione (backfill) dei fumetti già elaborati.
+
+process_comic salta i documenti già presenti su Cosmos DB, quindi dopo una modifica a
+_SYSTEM_PROMPT o al deployment del modello i fumetti esistenti restano con i vecchi metadati.
+Questo script rilegge i documenti da Cosmos DB (tutti o un sottoinsieme filtrato), richiama
+identify_comic_metadata con concorrenza limitata, aggiorna i documenti (solo se non modificati
+nel frattempo) e reindicizza AI Search a batch. L'avanzamento viene salvato su file tramite i continuation token di Cosmos DB,
+così il job può essere interrotto e ripreso.
+
+Esempi:
+    python backfill.py --dry-run
+    python backfill.py --user-id <id> --concurrency 4
+    python backfill.py --retry-failed
+    python backfill.py --reset
+"""
+import os
+import sys
+import json
+import logging
+import argparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from azure.cosmos.exceptions import CosmosResourceNotFoundError, CosmosAccessConditionFailedError
+from services.vision_service import identify_comic_metadata, build_comic_metadata, estimate_request_tokens
+from services.cosmos_service import replace_document, query_documents_by_page, count_documents
+from services.search_service import upload_batch_to_search
+
+logging.basicConfig(
+    stream=sys.stdout,
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+_DEFAULT_CHECKPOINT = ".backfill_checkpoint.json"
+
+# Campi indicizzati su AI Search (gli stessi caricati da process_comic)
+_SEARCH_FIELDS = ("id", "user_id", "original_image_url", "ai_analysis", "status", "upload_timestamp", "metadata")
+
+
+def _build_filter(user_id: str | None, since: str | None) -> tuple[str, list]:
+    """Costruisce il filtro (clausola WHERE) sui fumetti elaborati, con filtri opzionali."""
+    where_clause = "c.status = 'processed' AND IS_DEFINED(c.original_image_url)"
+    parameters = []
+    if user_id:
+        where_clause += " AND c.user_id = @user_id"
+        parameters.append({"name": "@user_id", "value": user_id})
+    if since:
+        where_clause += " AND c.upload_timestamp >= @since"
+        parameters.append({"name": "@since", "value": since})
+    return where_clause, parameters
+
+
+def _new_checkpoint(query: str, parameters: list) -> dict:
+    return {"query": query, "parameters": parameters, "continuation_token": None,
+            "completed": False, "processed": 0, "skipped": 0, "failed_ids": []}
+
+
+def _load_checkpoint(path: str, query: str, parameters: list) -> dict:
+    """
+    Carica il checkpoint se esiste ed è relativo alla stessa query.
+    Un checkpoint di una query diversa non può essere riusato (il continuation token non sarebbe valido).
+    """
+    if not os.path.exists(path):
+        return _new_checkpoint(query, parameters)
+
+    with open(path, encoding='utf-8') as f:
+        checkpoint = json.load(f)
+
+    if checkpoint.get("query") != query or checkpoint.get("parameters") != parameters:
+        raise ValueError(f"Il checkpoint '{path}' appartiene a filtri diversi. Usa --reset per ricominciare.")
+    return checkpoint
+
+
+def _save_checkpoint(path: str, checkpoint: dict):
+    """Scrive il checkpoint in modo atomico (file temporaneo + rename)."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _recatalogue(document: dict) -> tuple[str, dict | None]:
+    """
+    Rianalizza un fumetto con GPT-4o e aggiorna il documento su Cosmos DB.
+    Ritorna ("updated", documento aggiornato), ("skipped", None) se nel frattempo il documento
+    è stato eliminato o modificato, oppure ("failed", None) se l'analisi fallisce.
+    """
+    blob_url = document["original_image_url"]
+    ai_data = identify_comic_metadata(blob_url)
+    if not ai_data:
+        logging.warning(f"Analisi fallita per {document['id']}, documento lasciato invariato.")
+        return "failed", None
+
+    # Le proprietà di sistema di Cosmos DB (_rid, _etag, _ts, ...) non vanno riscritte
+    updated = {k: v for k, v in document.items() if not k.startswith('_')}
+    updated["ai_analysis"] = ai_data
+    updated["metadata"] = build_comic_metadata(ai_data, blob_url)
+    updated["recatalogue_timestamp"] = datetime.utcnow().isoformat() + "Z"
+
+    # Il replace condizionato evita di far "risorgere" un fumetto eliminato durante l'analisi
+    # e di sovrascrivere modifiche fatte dopo la lettura
+    try:
+        replace_document(updated, etag=document["_etag"])
+    except CosmosResourceNotFoundError:
+        logging.info(f"Fumetto {document['id']} eliminato durante l'analisi, saltato.")
+        return "skipped", None
+    except CosmosAccessConditionFailedError:
+        logging.info(f"Fumetto {document['id']} modificato durante l'analisi, saltato.")
+        return "skipped", None
+    return "updated", updated
+
+
+def _process_documents(executor: ThreadPoolExecutor, documents: list, checkpoint: dict):
+    """
+    Ricataloga in parallelo un gruppo di documenti, li reindicizza con un unico batch su AI Search
+    e aggiorna i contatori del checkpoint. Gli ID falliti restano in checkpoint["failed_ids"]
+    finché un nuovo tentativo (--retry-failed) non va a buon fine.
+    """
+    results = list(executor.map(_recatalogue, documents))
+    updated = [doc for outcome, doc in results if outcome == "updated"]
+    failed_ids = {document["id"] for document, (outcome, _) in zip(documents, results) if outcome == "failed"}
+
+    not_indexed = upload_batch_to_search([{k: doc.get(k) for k in _SEARCH_FIELDS} for doc in updated])
+    if not_indexed:
+        logging.warning(f"Documenti non indicizzati su AI Search: {', '.join(not_indexed)}")
+        failed_ids.update(not_indexed)
+
+    done_ids = {document["id"] for document in documents} - failed_ids
+    checkpoint["failed_ids"] = sorted((set(checkpoint["failed_ids"]) - done_ids) | failed_ids)
+    checkpoint["processed"] += len(updated) - len(not_indexed)
+    checkpoint["skipped"] += sum(1 for outcome, _ in results if outcome == "skipped")
+
+
+def run_backfill(user_id: str | None = None, since: str | None = None, concurrency: int = 4,
+                 page_size: int = 50, max_pages: int | None = None,
+                 checkpoint_path: str = _DEFAULT_CHECKPOINT, dry_run: bool = False,
+                 retry_failed: bool = False, reset: bool = False):
+    """
+    Esegue la ricatalogazione pagina per pagina.
+    Ogni pagina viene elaborata in parallelo, reindicizzata con un unico batch su AI Search
+    e solo dopo viene salvato il continuation token della pagina successiva.
+    Con retry_failed rielabora solo i fumetti falliti registrati nel checkpoint;
+    con reset riparte da un checkpoint vuoto (in dry-run il file esistente non viene toccato).
+    """
+    where_clause, parameters = _build_filter(user_id, since)
+    query = f"SELECT * FROM c WHERE {where_clause}"
+
+    if reset:
+        checkpoint = _new_checkpoint(query, parameters)
+        if not dry_run and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+    else:
+        checkpoint = _load_checkpoint(checkpoint_path, query, parameters)
+
+    if retry_failed:
+        return _retry_failed(checkpoint, concurrency, page_size, checkpoint_path, dry_run)
+
+    if checkpoint["completed"]:
+        logging.info("Il backfill risulta già completato. Usa --reset per ripeterlo.")
+        return checkpoint
+
+    if dry_run:
+        # Il conteggio avviene lato server; i documenti già elaborati nel checkpoint vengono sottratti
+        total = count_documents(where_clause, parameters)
+        already_done = checkpoint["processed"] + checkpoint["skipped"] + len(checkpoint["failed_ids"])
+        remaining = max(total - already_done, 0)
+        input_tokens, output_tokens = estimate_request_tokens()
+        logging.info(f"[dry-run] Fumetti da ricatalogare: ~{remaining} (su {total} che soddisfano i filtri)")
+        logging.info(f"[dry-run] Token stimati: ~{remaining * input_tokens} in input, "
+                     f"massimo {remaining * output_tokens} in output.")
+        return checkpoint
+
+    pages = query_documents_by_page(query, parameters, page_size, checkpoint["continuation_token"])
+    pages_done = 0
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for page in pages:
+            _process_documents(executor, list(page), checkpoint)
+            checkpoint["continuation_token"] = pages.continuation_token
+            checkpoint["completed"] = pages.continuation_token is None
+            _save_checkpoint(checkpoint_path, checkpoint)
+            logging.info(f"Pagina completata (totale: {checkpoint['processed']} ok, "
+                         f"{checkpoint['skipped']} saltati, {len(checkpoint['failed_ids'])} falliti).")
+
+            pages_done += 1
+            if max_pages and pages_done >= max_pages:
+                logging.info(f"Raggiunto il limite di {max_pages} pagine, il job può essere ripreso.")
+                break
+
+    if checkpoint["failed_ids"]:
+        logging.warning(f"{len(checkpoint['failed_ids'])} fumetti falliti: usa --retry-failed per rielaborarli.")
+
+    return checkpoint
+
+
+def _retry_failed(checkpoint: dict, concurrency: int, page_size: int, checkpoint_path: str, dry_run: bool) -> dict:
+    """Rielabora solo gli ID in checkpoint["failed_ids"], senza toccare il continuation token."""
+    retry_ids = list(checkpoint["failed_ids"])
+    if not retry_ids:
+        logging.info("Nessun fumetto fallito da rielaborare.")
+        return checkpoint
+
+    if dry_run:
+        input_tokens, output_tokens = estimate_request_tokens()
+        logging.info(f"[dry-run] Fumetti falliti da rielaborare: {len(retry_ids)}")
+        logging.info(f"[dry-run] Token stimati: ~{len(retry_ids) * input_tokens} in input, "
+                     f"massimo {len(retry_ids) * output_tokens} in output.")
+        return checkpoint
+
+    query = "SELECT * FROM c WHERE ARRAY_CONTAINS(@ids, c.id)"
+    pages = query_documents_by_page(query, [{"name": "@ids", "value": retry_ids}], page_size)
+    found_ids = set()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for page in pages:
+            documents = list(page)
+            found_ids.update(document["id"] for document in documents)
+            _process_documents(executor, documents, checkpoint)
+            _save_checkpoint(checkpoint_path, checkpoint)
+
+    # I fumetti non più presenti su Cosmos DB sono stati eliminati: non vanno ritentati
+    deleted_ids = set(retry_ids) - found_ids
+    checkpoint["failed_ids"] = sorted(set(checkpoint["failed_ids"]) - deleted_ids)
+    checkpoint["skipped"] += len(deleted_ids)
+    _save_checkpoint(checkpoint_path, checkpoint)
+    logging.info(f"Rielaborazione completata: {len(checkpoint['failed_ids'])} fumetti ancora falliti.")
+    return checkpoint
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ricatalogazione dei fumetti esistenti con il prompt/modello attuale.")
+    parser.add_argument("--user-id", help="Ricataloga solo i fumetti di questo utente")
+    parser.add_argument("--since", help="Ricataloga solo i fumetti caricati da questa data (ISO 8601)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Analisi contemporanee (limitate anche da OPENAI_MAX_CONCURRENCY)")
+    parser.add_argument("--page-size", type=int, default=50, help="Documenti per pagina (e per batch di indicizzazione)")
+    parser.add_argument("--max-pages", type=int, help="Si ferma dopo N pagine; il job riprende dal checkpoint")
+    parser.add_argument("--checkpoint", default=_DEFAULT_CHECKPOINT, help="File di checkpoint")
+    parser.add_argument("--reset", action="store_true", help="Ignora il checkpoint esistente e ricomincia")
+    parser.add_argument("--retry-failed", action="store_true", help="Rielabora solo i fumetti falliti registrati nel checkpoint")
+    parser.add_argument("--dry-run", action="store_true", help="Conta i fumetti rimanenti e stima i token senza chiamare OpenAI")
+    args = parser.parse_args()
+
+    run_backfill(
+        user_id=args.user_id,
+        since=args.since,
+        concurrency=args.concurrency,
+        page_size=args.page_size,
+        max_pages=args.max_pages,
+        checkpoint_path=args.checkpoint,
+        dry_run=args.dry_run,
+        retry_failed=args.retry_failed,
+        reset=args.reset
+    )
+
+
+if __name__ == '__main__':
+    main()
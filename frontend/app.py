@@ -3,16 +3,29 @@ import uuid
 import logging
 import sys
 import json
-from flask import Flask, render_template, request, jsonify, redirect
-from azure.storage.blob import BlobServiceClient
-from azure.cosmos import CosmosClient, PartitionKey
-from azure.servicebus import ServiceBusClient, ServiceBusMessage
-from azure.search.documents import SearchClient
-from werkzeug.middleware.proxy_fix import ProxyFix
-from azure.identity import DefaultAzureCredential
+import gzip
+import asyncio
+import hashlib
+from functools import wraps, lru_cache
+from quart import Quart, Response, render_template, request, jsonify, redirect, make_response
+from azure.storage.blob.aio import BlobServiceClient
+from azure.cosmos import PartitionKey
+from azure.cosmos.aio import CosmosClient
+from azure.servicebus import ServiceBusMessage
+from azure.servicebus.aio import ServiceBusClient
+from azure.search.documents.aio import SearchClient
+from hypercorn.middleware import ProxyFixMiddleware
+from azure.identity.aio import DefaultAzureCredential
 import filetype
+from coalescing import CoalescingSender, SingleFlight
 
-# Configurazione logging per Flask (visibile in Azure Log Stream)
+try:
+    import brotli
+except ImportError:
+    # Senza il pacchetto brotli si negozia solo gzip
+    brotli = None
+
+# Configurazione logging per Quart (visibile in Azure Log Stream)
 logging.basicConfig(
     stream=sys.stdout,
     level=logging.INFO,
@@ -21,11 +34,11 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-# Flask App
-app = Flask(__name__)
+# Quart App (API compatibile con Flask, servita via ASGI da Hypercorn)
+app = Quart(__name__)
 app.config['PREFERRED_URL_SCHEME'] = 'https'
 app.config['SESSION_COOKIE_SECURE'] = True
-app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
+app.asgi_app = ProxyFixMiddleware(app.asgi_app, mode="legacy", trusted_hops=1)
 
 # Variabili d'ambiente
 COSMOS_DB_NAME = os.environ.get("COSMOS_DB_NAME", "")
@@ -49,28 +62,236 @@ _missing = [k for k, v in _REQUIRED.items() if not v]
 if _missing:
     logger.critical(f"Variabili d'ambiente obbligatorie mancanti: {', '.join(_missing)}")
 
+# Compressione HTTP: solo per risposte testuali sopra la soglia (sotto non conviene)
+_COMPRESS_MIN_SIZE = 1024
+_COMPRESSIBLE_MIMETYPES = (
+    "text/html", "text/css", "text/plain", "application/json",
+    "application/javascript", "text/javascript", "image/svg+xml"
+)
+_SUPPORTED_ENCODINGS = ("br", "gzip") if brotli else ("gzip",)
+
+# Corpi compressi degli asset statici con fingerprint, per (filename, fingerprint, encoding).
+# None indica che la compressione non riduce la dimensione del file.
+_static_compressed_cache = {}
+
+# Cache degli asset statici con fingerprint (?v=<hash>): il contenuto di un URL versionato non cambia mai
+_STATIC_IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+
+# Client asincroni condivisi: creati alla prima richiesta e riusati per tutta la vita del worker
+_credential = None
+_cosmos_client = None
 _container_client = None
-def get_container():
+_container_lock = asyncio.Lock()
+_blob_service_client = None
+_search_client = None
+_servicebus_client = None
+
+
+def get_credential():
+    """Restituisce la credenziale Managed Identity condivisa."""
+    global _credential
+    if _credential is None:
+        _credential = DefaultAzureCredential()
+    return _credential
+
+
+async def get_container():
     """
     Crea e restituisce il container client di Cosmos DB.
     """
-    global _container_client
+    global _cosmos_client, _container_client
     if _container_client is not None:
         return _container_client
-        
-    credential = DefaultAzureCredential()
-    client = CosmosClient(url=COSMOS_ENDPOINT, credential=credential)
-    database = client.get_database_client(COSMOS_DB_NAME)
-    _container_client = database.create_container_if_not_exists(
-        id=COSMOS_CONTAINER_NAME,
-        partition_key=PartitionKey(path="/id"),
-        default_ttl=-1
-    )
+
+    async with _container_lock:
+        if _container_client is None:
+            _cosmos_client = CosmosClient(url=COSMOS_ENDPOINT, credential=get_credential())
+            database = _cosmos_client.get_database_client(COSMOS_DB_NAME)
+            _container_client = await database.create_container_if_not_exists(
+                id=COSMOS_CONTAINER_NAME,
+                partition_key=PartitionKey(path="/id"),
+                default_ttl=-1
+            )
     return _container_client
 
 
+def get_blob_service_client():
+    """Restituisce il client condiviso di Blob Storage."""
+    global _blob_service_client
+    if _blob_service_client is None:
+        _blob_service_client = BlobServiceClient(account_url=STORAGE_ENDPOINT, credential=get_credential())
+    return _blob_service_client
+
+
+def get_search_client():
+    """Restituisce il client condiviso di AI Search."""
+    global _search_client
+    if _search_client is None:
+        _search_client = SearchClient(
+            endpoint=SEARCH_ENDPOINT,
+            index_name=SEARCH_INDEX_NAME,
+            credential=get_credential()
+        )
+    return _search_client
+
+
+def get_servicebus_client():
+    """Restituisce il client condiviso di Service Bus."""
+    global _servicebus_client
+    if _servicebus_client is None:
+        _servicebus_client = ServiceBusClient(
+            fully_qualified_namespace=os.environ["SERVICEBUS_NAMESPACE"],
+            credential=get_credential()
+        )
+    return _servicebus_client
+
+
+# Sender di lunga durata per la coda di eliminazione e accorpamento delle letture concorrenti
+_delete_sender = CoalescingSender(get_servicebus_client, "delete-comic-queue")
+_comic_reads = SingleFlight()
+
+
+async def read_comic(comic_id: str) -> dict:
+    """
+    Legge un fumetto da Cosmos DB; le letture concorrenti dello stesso ID condividono un'unica richiesta.
+    Il documento restituito è condiviso e non va modificato.
+    """
+    container = await get_container()
+    return await _comic_reads.do(
+        comic_id,
+        lambda: container.read_item(item=comic_id, partition_key=comic_id)
+    )
+
+
+@app.after_serving
+async def close_clients():
+    """Chiude le connessioni dei client condivisi allo spegnimento del worker."""
+    await _delete_sender.close()
+    for client in (_servicebus_client, _search_client, _blob_service_client, _cosmos_client, _credential):
+        if client is not None:
+            await client.close()
+
+
+@lru_cache(maxsize=None)
+def _file_fingerprint(path: str, mtime: float) -> str:
+    """Hash del contenuto di un file statico (la mtime nella chiave invalida la cache se il file cambia)."""
+    with open(path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()[:12]
+
+
+def static_fingerprint(filename: str) -> str | None:
+    """Restituisce il fingerprint di un file in static/, o None se il file non esiste."""
+    path = os.path.join(app.static_folder, filename)
+    try:
+        return _file_fingerprint(path, os.path.getmtime(path))
+    except OSError:
+        return None
+
+
+@app.url_defaults
+def add_static_fingerprint(endpoint, values):
+    """Aggiunge ?v=<hash> agli URL generati con url_for('static', ...)."""
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        fingerprint = static_fingerprint(values['filename'])
+        if fingerprint:
+            values['v'] = fingerprint
+
+
+def conditional(view):
+    """
+    Aggiunge ETag e supporto a If-None-Match alle risposte JSON cacheabili.
+    I dati sono per utente, quindi la cache è privata e va sempre rivalidata.
+    """
+    @wraps(view)
+    async def wrapper(*args, **kwargs):
+        response = await make_response(await view(*args, **kwargs))
+        if response.status_code != 200:
+            return response
+
+        etag = hashlib.md5(await response.get_data()).hexdigest()
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+
+        if request.if_none_match.contains_weak(etag):
+            return Response("", status=304, headers={
+                'ETag': response.headers['ETag'],
+                'Cache-Control': response.headers['Cache-Control']
+            })
+        return response
+    return wrapper
+
+
+@app.after_request
+async def add_cache_headers(response):
+    """Cache a lungo termine per gli asset statici con fingerprint corretto (anche sui 304)."""
+    if request.endpoint == 'static' and response.status_code in (200, 304):
+        filename = request.view_args.get('filename')
+        version = request.args.get('v')
+        if version and version == static_fingerprint(filename):
+            response.headers['Cache-Control'] = _STATIC_IMMUTABLE_CACHE
+        else:
+            response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+async def _compress(data: bytes, encoding: str) -> bytes:
+    """Comprime fuori dall'event loop: su payload grandi la compressione è CPU-bound."""
+    if encoding == 'br':
+        return await asyncio.to_thread(brotli.compress, data, quality=5)
+    return await asyncio.to_thread(gzip.compress, data, 6)
+
+
+@app.after_request
+async def compress_response(response):
+    """Comprime la risposta con brotli o gzip in base all'header Accept-Encoding."""
+    response.vary.add('Accept-Encoding')
+
+    if (response.status_code != 200
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in _COMPRESSIBLE_MIMETYPES):
+        return response
+
+    encoding = request.accept_encodings.best_match(_SUPPORTED_ENCODINGS)
+    if encoding is None:
+        return response
+
+    data = await response.get_data()
+    if len(data) < _COMPRESS_MIN_SIZE:
+        return response
+
+    # Gli asset statici con fingerprint sono immutabili: si comprimono una sola volta per worker
+    cache_key = None
+    if request.endpoint == 'static':
+        filename = request.view_args.get('filename')
+        fingerprint = static_fingerprint(filename)
+        if fingerprint and request.args.get('v') == fingerprint:
+            cache_key = (filename, fingerprint, encoding)
+
+    if cache_key in _static_compressed_cache:
+        compressed = _static_compressed_cache[cache_key]
+    else:
+        compressed = await _compress(data, encoding)
+        if len(compressed) >= len(data):
+            compressed = None
+        if cache_key is not None:
+            _static_compressed_cache[cache_key] = compressed
+
+    # Se la compressione non riduce la dimensione si invia il corpo originale
+    if compressed is None:
+        return response
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+
+    # Il corpo compresso non è identico byte per byte: un ETag forte diventa debole
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
 @app.after_request
-def add_security_headers(response):
+async def add_security_headers(response):
     """Aggiunge header di sicurezza HTTP alla risposta."""
     response.headers['X-Content-Type-Options'] = 'nosniff'
     response.headers['X-Frame-Options'] = 'SAMEORIGIN'
@@ -99,45 +320,45 @@ def get_user_email() -> str:
 # ---------------------------------------------------------------------------
 
 @app.route('/')
-def home():
+async def home():
     """Pagina principale: upload foto."""
-    return render_template('home.html', user_email=get_user_email())
+    return await render_template('home.html', user_email=get_user_email())
 
 
 @app.route('/collezione')
-def collezione():
+async def collezione():
     """Pagina collezione: mostra i fumetti dell'utente."""
     user_id = get_user_id()
     comics = []
     try:
-        container = get_container()
+        container = await get_container()
         query = "SELECT * FROM c WHERE (c.user_id = @user_id OR NOT IS_DEFINED(c.user_id)) AND c.status != 'error'"
         parameters = [{"name": "@user_id", "value": user_id}]
 
-        comics = list(container.query_items(
+        comics = [item async for item in container.query_items(
             query=query,
-            parameters=parameters,
-            enable_cross_partition_query=True
-        ))
-        
+            parameters=parameters
+        )]
+
     except Exception as e:
         logger.error(f"Errore query Cosmos: {e}")
 
-    return render_template('collezione.html', comics=comics, user_email=get_user_email())
+    return await render_template('collezione.html', comics=comics, user_email=get_user_email())
 
 
 @app.route('/logout')
-def logout():
+async def logout():
     return redirect("/.auth/logout?post_logout_redirect_uri=/")
 
 
 @app.route('/api/upload', methods=['POST'])
-def upload_image():
+async def upload_image():
     """API per caricare immagine su Blob Storage."""
-    if 'file' not in request.files:
+    files = await request.files
+    if 'file' not in files:
         return jsonify({'error': 'Nessun file'}), 400
 
-    file = request.files['file']
+    file = files['file']
     if file.filename == '':
         return jsonify({'error': 'Nome file vuoto'}), 400
 
@@ -161,14 +382,12 @@ def upload_image():
         user_id = get_user_id()
         blob_name = f"{user_id}/{uuid.uuid4()}.{kind.extension}"
 
-        credential = DefaultAzureCredential()
-        blob_service_client = BlobServiceClient(account_url=STORAGE_ENDPOINT, credential=credential)
-        blob_client = blob_service_client.get_blob_client(
+        blob_client = get_blob_service_client().get_blob_client(
             container=BLOB_CONTAINER_NAME,
             blob=blob_name
         )
 
-        blob_client.upload_blob(file, overwrite=True)
+        await blob_client.upload_blob(file.read(), overwrite=True)
 
         return jsonify({
             'success': True,
@@ -182,12 +401,12 @@ def upload_image():
 
 
 @app.route('/api/comic/<comic_id>')
-def get_comic_details(comic_id):
+@conditional
+async def get_comic_details(comic_id):
     """API per ottenere i dettagli di un fumetto specifico."""
     try:
         user_id = get_user_id()
-        container = get_container()
-        comic = container.read_item(item=comic_id, partition_key=comic_id)
+        comic = await read_comic(comic_id)
 
         if comic.get('user_id') and comic.get('user_id') != user_id:
             return jsonify({'error': 'Non autorizzato a visualizzare questo fumetto'}), 403
@@ -198,15 +417,14 @@ def get_comic_details(comic_id):
 
 
 @app.route('/api/delete_comic/<comic_id>', methods=['DELETE'])
-def delete_comic(comic_id):
+async def delete_comic(comic_id):
     """Elimina un fumetto inviando un messaggio alla coda Service Bus."""
     try:
         user_id = get_user_id()
-        container = get_container()
 
         # 1. Recupera il documento per verificare la proprietà (IDOR Fix)
         try:
-            item = container.read_item(item=comic_id, partition_key=comic_id)
+            item = await read_comic(comic_id)
         except Exception:
             return jsonify({'error': 'Fumetto non trovato'}), 404
 
@@ -214,17 +432,12 @@ def delete_comic(comic_id):
         if item.get('user_id') and item.get('user_id') != user_id:
             return jsonify({'error': 'Non autorizzato a eliminare questo fumetto'}), 403
 
-        # 3. Invia messaggio alla coda di eliminazione
+        # 3. Invia messaggio alla coda di eliminazione (accorpato in batch con le altre richieste)
         delete_message = {
             "comic_id": comic_id,
             "blob_url": item.get('original_image_url')
         }
-        credential = DefaultAzureCredential()
-        sb_namespace = os.environ["SERVICEBUS_NAMESPACE"]
-        with ServiceBusClient(fully_qualified_namespace=sb_namespace, credential=credential) as sb_client:
-            sender = sb_client.get_queue_sender(queue_name="delete-comic-queue")
-            with sender:
-                sender.send_messages(ServiceBusMessage(json.dumps(delete_message)))
+        await _delete_sender.send(ServiceBusMessage(json.dumps(delete_message)))
 
         return jsonify({'success': True, 'message': 'Eliminazione in corso...'})
     except Exception as e:
@@ -232,8 +445,17 @@ def delete_comic(comic_id):
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/metrics')
+async def metrics():
+    """Contatori del worker corrente: batch inviati a Service Bus e letture Cosmos accorpate."""
+    return jsonify({
+        'delete_queue': _delete_sender.stats(),
+        'comic_reads': _comic_reads.stats()
+    })
+
+
 @app.route('/api/check_status')
-def check_status():
+async def check_status():
     """Controlla se l'analisi AI è completata cercando il documento su Cosmos DB."""
     user_id = get_user_id()
     blob_name = request.args.get('blob_name')
@@ -242,7 +464,7 @@ def check_status():
         return jsonify({'status': 'error', 'message': 'Manca blob_name'}), 400
 
     try:
-        container = get_container()
+        container = await get_container()
         query = "SELECT * FROM c WHERE c.user_id = @user_id AND ENDSWITH(c.original_image_url, @blob_name)"
         parameters = [
             {"name": "@user_id", "value": user_id},
@@ -250,11 +472,10 @@ def check_status():
         ]
 
         logger.info(f"check_status polling: user={user_id}, blob={blob_name}")
-        items = list(container.query_items(
+        items = [item async for item in container.query_items(
             query=query,
-            parameters=parameters,
-            enable_cross_partition_query=True
-        ))
+            parameters=parameters
+        )]
 
         if items:
             doc = items[0]
@@ -274,7 +495,8 @@ def check_status():
 
 
 @app.route('/api/search')
-def search_comics():
+@conditional
+async def search_comics():
     """API che interroga Azure AI Search per la ricerca full-text."""
     user_id = get_user_id()
     query = request.args.get('q', '*')
@@ -287,14 +509,7 @@ def search_comics():
         query = "*"
 
     try:
-        credential = DefaultAzureCredential()
-        search_client = SearchClient(
-            endpoint=SEARCH_ENDPOINT, 
-            index_name=SEARCH_INDEX_NAME, 
-            credential=credential
-        )
-
-        results = search_client.search(
+        results = await get_search_client().search(
             search_text=query,
             filter=f"user_id eq '{user_id}' and status ne 'error'",
             select=["id", "metadata"],
@@ -302,7 +517,7 @@ def search_comics():
             query_type="full"
         )
 
-        output = [{'id': res['id'], 'metadata': res['metadata']} for res in results]
+        output = [{'id': res['id'], 'metadata': res['metadata']} async for res in results]
         return jsonify({'results': output})
 
     except Exception as e:
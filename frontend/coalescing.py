@@ -0,0 +1,170 @@
+import asyncio
+import logging
+from azure.servicebus.exceptions import MessageSizeExceededError
+
+logger = logging.getLogger(__name__)
+
+
+class CoalescingSender:
+    """
+    Sender Service Bus di lunga durata che accorpa i messaggi in ServiceBusMessageBatch.
+    I messaggi accodati entro flush_interval secondi vengono inviati con un'unica chiamata;
+    send() ritorna solo quando il batch che contiene il messaggio è stato consegnato.
+    """
+
+    def __init__(self, client_factory, queue_name: str, flush_interval: float = 0.005):
+        self._client_factory = client_factory
+        self._queue_name = queue_name
+        self._flush_interval = flush_interval
+        self._sender = None
+        self._pending = None
+        self._inflight = []
+        self._task = None
+        self._closed = False
+
+        # Contatori (per worker)
+        self.messages_sent = 0
+        self.batches_sent = 0
+        self.max_batch_size = 0
+
+    async def send(self, message):
+        """Accoda un messaggio e attende l'invio del batch che lo contiene."""
+        if self._closed:
+            raise RuntimeError(f"Sender per '{self._queue_name}' chiuso: messaggio non inviato.")
+
+        # Se il task di flush è terminato lo si riavvia sulla stessa coda, senza perdere i messaggi in attesa
+        if self._pending is None:
+            self._pending = asyncio.Queue()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._pending.put((message, future))
+        await future
+
+    def stats(self) -> dict:
+        return {
+            "messages_sent": self.messages_sent,
+            "batches_sent": self.batches_sent,
+            "max_batch_size": self.max_batch_size,
+        }
+
+    async def close(self):
+        """
+        Ferma il task di flush e chiude il link verso la coda.
+        I messaggi non ancora inviati (in coda o nel batch interrotto) falliscono subito,
+        così le richieste in attesa non restano appese fino allo spegnimento del server.
+        """
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+        orphaned = [future for _, future in self._inflight]
+        while self._pending is not None and not self._pending.empty():
+            orphaned.append(self._pending.get_nowait()[1])
+        for future in orphaned:
+            if not future.done():
+                future.set_exception(RuntimeError(f"Sender per '{self._queue_name}' chiuso: messaggio non inviato."))
+        self._inflight = []
+
+        if self._sender is not None:
+            await self._sender.close()
+
+    async def _run(self):
+        while True:
+            # Attende il primo messaggio, poi lascia qualche millisecondo per raccoglierne altri
+            pending = [await self._pending.get()]
+            await asyncio.sleep(self._flush_interval)
+            while not self._pending.empty():
+                pending.append(self._pending.get_nowait())
+
+            self._inflight = pending
+            try:
+                await self._flush(pending)
+            except Exception as e:
+                logger.error(f"Errore invio batch su '{self._queue_name}': {e}")
+                for _, future in pending:
+                    if not future.done():
+                        future.set_exception(e)
+            self._inflight = []
+
+    async def _flush(self, pending: list):
+        if self._sender is None:
+            self._sender = self._client_factory().get_queue_sender(queue_name=self._queue_name)
+
+        batch, in_batch = await self._sender.create_message_batch(), []
+        for message, future in pending:
+            if not self._try_add(batch, message):
+                if in_batch:
+                    # Batch pieno: lo invia e ricomincia con un batch nuovo
+                    await self._send_batch(batch, in_batch)
+                    batch, in_batch = await self._sender.create_message_batch(), []
+                if not self._try_add(batch, message):
+                    # Il messaggio da solo supera la dimensione massima di un batch
+                    if not future.done():
+                        future.set_exception(MessageSizeExceededError("Messaggio troppo grande per la coda."))
+                    continue
+            in_batch.append(future)
+
+        if in_batch:
+            await self._send_batch(batch, in_batch)
+
+    @staticmethod
+    def _try_add(batch, message) -> bool:
+        try:
+            batch.add_message(message)
+            return True
+        except MessageSizeExceededError:
+            return False
+
+    async def _send_batch(self, batch, futures: list):
+        await self._sender.send_messages(batch)
+        self.batches_sent += 1
+        self.messages_sent += len(futures)
+        self.max_batch_size = max(self.max_batch_size, len(futures))
+        for future in futures:
+            if not future.done():
+                future.set_result(None)
+
+
+class SingleFlight:
+    """
+    Accorpa le chiamate concorrenti con la stessa chiave: finché una chiamata è in corso,
+    le richieste identiche attendono lo stesso risultato invece di ripeterla.
+    Il risultato è condiviso tra i chiamanti e non va modificato.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+        # Contatori (per worker)
+        self.executed = 0
+        self.merged = 0
+
+    async def do(self, key, coro_factory):
+        """Esegue coro_factory() una sola volta per chiave tra le chiamate concorrenti."""
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(coro_factory())
+            self._calls[key] = future
+            future.add_done_callback(lambda done: self._forget(key, done))
+            self.executed += 1
+        else:
+            self.merged += 1
+
+        # shield: se un chiamante viene cancellato, gli altri continuano ad attendere la stessa chiamata
+        return await asyncio.shield(future)
+
+    def _forget(self, key, future):
+        self._calls.pop(key, None)
+        # Recupera l'eccezione anche se tutti i chiamanti sono stati cancellati,
+        # altrimenti asyncio segnala "Task exception was never retrieved"
+        if not future.cancelled():
+            future.exception()
+
+    def stats(self) -> dict:
+        return {"executed": self.executed, "merged": self.merged}
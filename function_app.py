@@ -7,7 +7,7 @@ import hashlib
 from datetime import datetime
 from azure.cosmos.exceptions import CosmosResourceNotFoundError
 from services.blob_service import delete_blob, extract_user_id
-from services.vision_service import identify_comic_metadata
+from services.vision_service import identify_comic_metadata, build_comic_metadata
 from services.cosmos_service import save_document, delete_document, get_container
 from services.search_service import upload_to_search, delete_from_search
 
@@ -77,32 +77,7 @@ def process_comic(msg: func.ServiceBusMessage):
         comic_metadata = None
         if ai_data:
             logging.info(f"AI ha restituito dati: {ai_data.get('title')}")
-            comic_metadata = {
-                "title": ai_data.get('title', 'Titolo Sconosciuto'),
-                "issue_number": ai_data.get('issue_number'),
-                "publish_date": ai_data.get('publication_year', 'N/D'),
-                "plot": ai_data.get('plot', 'Trama non disponibile.'),
-                "cover_url": blob_url,
-                "publisher": ai_data.get('publisher', 'N/D'),
-                "format_type": ai_data.get('format_type', 'Issue'),
-                
-                # credits
-                "writers": ai_data.get('writers', ['N/D']),
-                "artists": ai_data.get('artists', ['N/D']),
-                "colorists": ai_data.get('colorists', ['N/D']),
-                "editors": ai_data.get('editors', ['N/D']),
-                "cover_artists": ai_data.get('cover_artists', ['N/D']),
-                
-                # content
-                "characters": ai_data.get('characters', ['N/D']),
-                "teams": ai_data.get('teams', ['N/D']),
-                "locations": ai_data.get('locations', ['N/D']),
-                "genres": ai_data.get('genres', ['N/D']),
-                "rating": ai_data.get('rating', 'N/D'),
-                
-                "original_us_info": ai_data.get('original_us_info', {}),
-                "ai_is_pure_source": True
-            }
+            comic_metadata = build_comic_metadata(ai_data, blob_url)
         else:
             logging.error("GPT-4o non è riuscito ad analizzare l'immagine.")
 
@@ -1,5 +1,6 @@
 import os
 import logging
+from azure.core import MatchConditions
 from azure.cosmos import CosmosClient, PartitionKey
 from azure.identity import DefaultAzureCredential
 
@@ -41,6 +42,49 @@ def save_document(document: dict):
     return container.create_item(body=document)
 
 
+def replace_document(document: dict, etag: str):
+    """
+    Sostituisce un documento esistente solo se non è stato modificato dopo la lettura (controllo ETag).
+    Solleva CosmosResourceNotFoundError se il documento è stato eliminato
+    e CosmosAccessConditionFailedError se è stato modificato nel frattempo.
+    """
+    container = get_container()
+    return container.replace_item(
+        item=document["id"],
+        body=document,
+        etag=etag,
+        match_condition=MatchConditions.IfNotModified
+    )
+
+
+def query_documents_by_page(query: str, parameters: list | None = None, page_size: int = 50, continuation_token: str | None = None):
+    """
+    Esegue una query cross-partition restituendo un iteratore di pagine.
+    Il continuation_token dell'iteratore permette di riprendere la lettura da dove si era interrotta.
+    """
+    container = get_container()
+    items = container.query_items(
+        query=query,
+        parameters=parameters or [],
+        enable_cross_partition_query=True,
+        max_item_count=page_size
+    )
+    return items.by_page(continuation_token)
+
+
+def count_documents(where_clause: str, parameters: list | None = None) -> int:
+    """
+    Conta i documenti che soddisfano il filtro senza scaricarli (SELECT VALUE COUNT(1)).
+    """
+    container = get_container()
+    results = container.query_items(
+        query=f"SELECT VALUE COUNT(1) FROM c WHERE {where_clause}",
+        parameters=parameters or [],
+        enable_cross_partition_query=True
+    )
+    return sum(results)
+
+
 def delete_document(comic_id: str):
     """
     Elimina un documento da Cosmos DB dato il suo ID.
@@ -41,6 +41,24 @@ def upload_to_search(document: dict):
         raise
 
 
+def upload_batch_to_search(documents: list):
+    """
+    Carica o aggiorna più documenti nell'indice di AI Search con una sola richiesta.
+    Ritorna la lista degli ID che AI Search non è riuscito a indicizzare.
+    """
+    if not documents:
+        return []
+    try:
+        client = _get_search_client()
+        results = client.upload_documents(documents)
+        failed = [r.key for r in results if not r.succeeded]
+        logging.info(f"Batch di {len(documents)} documenti caricato su AI Search ({len(failed)} falliti).")
+        return failed
+    except Exception as e:
+        logging.error(f"Errore upload batch su AI Search: {str(e)}")
+        raise
+
+
 def delete_from_search(comic_id: str):
     """
     Elimina un documento dall'indice di AI Search dato il suo ID.
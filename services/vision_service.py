@@ -2,9 +2,32 @@ import os
 import requests
 import json
 import logging
+import time
+import threading
 from azure.identity import DefaultAzureCredential
 
 # Costanti configurabili
+_USER_PROMPT = "Identifica i dati di questo fumetto."
+_MAX_TOKENS = 500
+
+# Stima dei token consumati dall'immagine con "detail": "auto" (85 di base + 170 per tile da 512px).
+# Una copertina 2:3 viene ridotta a 768x1152, cioè 6 tile: 85 + 6 * 170 = 1105.
+# Immagini molto più alte che larghe arrivano a 8 tile (1445 token).
+_IMAGE_TOKENS_ESTIMATE = 1105
+
+# Limite condiviso: massimo di chiamate contemporanee verso Azure OpenAI per processo
+_OPENAI_MAX_CONCURRENCY = int(os.environ.get("OPENAI_MAX_CONCURRENCY", "4"))
+_openai_semaphore = threading.BoundedSemaphore(_OPENAI_MAX_CONCURRENCY)
+
+# Retry con backoff esponenziale su throttling (429) ed errori transitori
+_MAX_RETRIES = 4
+_RETRY_BASE_DELAY = 2
+_RETRY_MAX_DELAY = 60
+_RETRYABLE_STATUS = (408, 429, 500, 502, 503, 504)
+
+# Timeout (connessione, lettura) in secondi: senza, una connessione bloccata occupa per sempre uno slot del semaforo
+_REQUEST_TIMEOUT = (10, 120)
+
 _SYSTEM_PROMPT = """
 Sei il più grande esperto mondiale di fumetti, archivista e catalogatore professionista.
 Conosci perfettamente le edizioni USA (Marvel, DC, Image) e le edizioni ITALIANE (Panini Comics, Star Comics, Bonelli, RW Lion).
@@ -74,30 +97,103 @@ def identify_comic_metadata(blob_url: str) -> dict | None:
         "Content-Type": "application/json"
     }
 
-    try:
-        response = requests.post(
-            _OPENAI_URI,
-            headers=headers,
-            json={
-                "messages": [
-                    {"role": "system", "content": _SYSTEM_PROMPT},
-                    {"role": "user", "content": [
-                        {"type": "text", "text": "Identifica i dati di questo fumetto."},
-                        {"type": "image_url", "image_url": {"url": blob_url, "detail": "auto"}}
-                    ]}
-                ],
-                "response_format": {"type": "json_object"},
-                "max_tokens": 500,
-                "temperature": 0.1
-            }
-        )
-
-        response.raise_for_status()
-
-        return json.loads(response.json()["choices"][0]["message"]["content"])
-
-    except Exception as e:
-        logging.error(f"Errore GPT-4o: {type(e).__name__}: {e}")
-        if hasattr(e, 'response'):
-            logging.error(f"Dettaglio Errore AI: {e.response.text}")
-        return None
+    for attempt in range(_MAX_RETRIES + 1):
+        try:
+            with _openai_semaphore:
+                response = _post_chat_completion(_OPENAI_URI, headers, blob_url)
+
+            if response.status_code in _RETRYABLE_STATUS and attempt < _MAX_RETRIES:
+                delay = _retry_delay(attempt, response.headers.get("Retry-After"))
+                logging.warning(f"GPT-4o ha risposto {response.status_code}, nuovo tentativo tra {delay}s.")
+                time.sleep(delay)
+                continue
+
+            response.raise_for_status()
+
+            return json.loads(response.json()["choices"][0]["message"]["content"])
+
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt < _MAX_RETRIES:
+                delay = _retry_delay(attempt)
+                logging.warning(f"Errore di rete verso GPT-4o ({type(e).__name__}), nuovo tentativo tra {delay}s.")
+                time.sleep(delay)
+                continue
+            logging.error(f"Errore GPT-4o: {type(e).__name__}: {e}")
+            return None
+
+        except Exception as e:
+            logging.error(f"Errore GPT-4o: {type(e).__name__}: {e}")
+            if getattr(e, 'response', None) is not None:
+                logging.error(f"Dettaglio Errore AI: {e.response.text}")
+            return None
+
+
+def _retry_delay(attempt: int, retry_after: str | None = None) -> float:
+    """Attesa prima del prossimo tentativo: Retry-After se presente, altrimenti backoff esponenziale."""
+    if retry_after:
+        try:
+            return min(float(retry_after), _RETRY_MAX_DELAY)
+        except ValueError:
+            pass
+    return min(_RETRY_BASE_DELAY * 2 ** attempt, _RETRY_MAX_DELAY)
+
+
+def _post_chat_completion(uri: str, headers: dict, blob_url: str):
+    return requests.post(
+        uri,
+        headers=headers,
+        timeout=_REQUEST_TIMEOUT,
+        json={
+            "messages": [
+                {"role": "system", "content": _SYSTEM_PROMPT},
+                {"role": "user", "content": [
+                    {"type": "text", "text": _USER_PROMPT},
+                    {"type": "image_url", "image_url": {"url": blob_url, "detail": "auto"}}
+                ]}
+            ],
+            "response_format": {"type": "json_object"},
+            "max_tokens": _MAX_TOKENS,
+            "temperature": 0.1
+        }
+    )
+
+
+def build_comic_metadata(ai_data: dict, blob_url: str) -> dict:
+    """
+    Normalizza la risposta di GPT-4o nel campo "metadata" del documento Cosmos DB.
+    """
+    return {
+        "title": ai_data.get('title', 'Titolo Sconosciuto'),
+        "issue_number": ai_data.get('issue_number'),
+        "publish_date": ai_data.get('publication_year', 'N/D'),
+        "plot": ai_data.get('plot', 'Trama non disponibile.'),
+        "cover_url": blob_url,
+        "publisher": ai_data.get('publisher', 'N/D'),
+        "format_type": ai_data.get('format_type', 'Issue'),
+
+        # credits
+        "writers": ai_data.get('writers', ['N/D']),
+        "artists": ai_data.get('artists', ['N/D']),
+        "colorists": ai_data.get('colorists', ['N/D']),
+        "editors": ai_data.get('editors', ['N/D']),
+        "cover_artists": ai_data.get('cover_artists', ['N/D']),
+
+        # content
+        "characters": ai_data.get('characters', ['N/D']),
+        "teams": ai_data.get('teams', ['N/D']),
+        "locations": ai_data.get('locations', ['N/D']),
+        "genres": ai_data.get('genres', ['N/D']),
+        "rating": ai_data.get('rating', 'N/D'),
+
+        "original_us_info": ai_data.get('original_us_info', {}),
+        "ai_is_pure_source": True
+    }
+
+
+def estimate_request_tokens() -> tuple[int, int]:
+    """
+    Stima approssimativa dei token di una chiamata a identify_comic_metadata.
+    Ritorna (token in input, token massimi in output); usa ~4 caratteri per token per il testo.
+    """
+    prompt_chars = len(_SYSTEM_PROMPT) + len(_USER_PROMPT)
+    return prompt_chars // 4 + _IMAGE_TOKENS_ESTIMATE, _MAX_TOKENS